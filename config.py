@@ -10,7 +10,7 @@ SHEETS_SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 SCOPES = GMAIL_SCOPES + SHEETS_SCOPES
 
 # Credentials
-CREDENTIALS_FILE = os.path.join('../credentials', 'credentials.json')
+CREDENTIALS_FILE = os.path.join('credentials', 'credentials.json')
 TOKEN_FILE = 'token.json'
 
 # State Management
@@ -22,3 +22,12 @@ DATABASE_FILE = 'state.db'
 # URL format: https://docs.google.com/spreadsheets/d/{SPREADSHEET_ID}/edit
 SPREADSHEET_ID = 'your_spreadsheet_id'
 SHEET_NAME = 'Sheet1'  # Name of the sheet tab
+
+# Marker file written once the sheet's header row is in place, so later runs
+# can skip the header check (delete it or run with --force-init to re-check)
+HEADER_SENTINEL = '.sheet_header_initialized'
+
+# Marker file recording that the spreadsheet was reachable, so runs within
+# ACCESS_CACHE_TTL seconds of a successful check can skip it
+ACCESS_CACHE_FILE = '.sheets_access_ok'
+ACCESS_CACHE_TTL = 24 * 60 * 60
@@ -1,26 +1,101 @@
 import sqlite3
 from datetime import datetime
 
-def init_db():
-    # This creates a file named 'state.db' in your project folder
-    conn = sqlite3.connect('state.db')
-    cursor = conn.cursor()
-    
-    # Create a table to store processed message IDs with timestamp
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS processed_emails (
-            message_id TEXT PRIMARY KEY,
-            processed_at TEXT NOT NULL
-        )
+# Single connection shared by every query for the lifetime of the process.
+# SQLite never fsyncs (synchronous=OFF), including when it checkpoints the WAL.
+# If the process itself crashes, WAL keeps the file consistent. An OS crash or
+# power loss, though, can leave state.db corrupt, not just missing the latest
+# commits. A corrupt state.db errors on open and has to be deleted; the next
+# run then starts from scratch and reprocesses any emails that are still unread.
+_conn = sqlite3.connect('state.db', check_same_thread=False)
+_conn.executescript('''
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=OFF;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-65536;
+''')
+
+# processed_emails is keyed by message_id only, so it is stored WITHOUT ROWID:
+# the primary key B-tree holds the rows directly instead of duplicating them
+# in a separate rowid table.
+_PROCESSED_EMAILS_DDL = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        message_id TEXT PRIMARY KEY,
+        processed_at INTEGER NOT NULL
+    ) WITHOUT ROWID
+'''
+
+def _migrate_processed_emails():
+    # One-off rebuild of a processed_emails table created before WITHOUT ROWID;
+    # ISO text timestamps from older versions are converted to nanoseconds.
+    _conn.execute('BEGIN')
+    _conn.execute('DROP TABLE IF EXISTS processed_emails_new')
+    _conn.execute(_PROCESSED_EMAILS_DDL.format(table='processed_emails_new'))
+    _conn.execute('''
+        INSERT INTO processed_emails_new (message_id, processed_at)
+        SELECT message_id,
+               CASE WHEN typeof(processed_at) = 'text'
+                    THEN COALESCE(CAST(strftime('%s', processed_at) AS INTEGER), 0) * 1000000000
+                    ELSE processed_at
+               END
+        FROM processed_emails
     ''')
-    
-    # Create a table to store the last run timestamp
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS last_run (
-            id INTEGER PRIMARY KEY CHECK (id = 1),
-            timestamp TEXT NOT NULL
-        )
+    _conn.execute('DROP TABLE processed_emails')
+    _conn.execute('ALTER TABLE processed_emails_new RENAME TO processed_emails')
+
+# last_run holds a single row with the timestamp as integer nanoseconds
+_LAST_RUN_DDL = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        timestamp INTEGER NOT NULL
+    )
+'''
+
+def _migrate_last_run():
+    # One-off rebuild of a last_run table created with a TEXT timestamp column.
+    # Older versions stored ISO text (UTC); a nanosecond value written into the
+    # TEXT column was stored as a string of digits. Both become integers.
+    if not _conn.in_transaction:
+        _conn.execute('BEGIN')
+    _conn.execute('DROP TABLE IF EXISTS last_run_new')
+    _conn.execute(_LAST_RUN_DDL.format(table='last_run_new'))
+    _conn.execute('''
+        INSERT INTO last_run_new (id, timestamp)
+        SELECT id,
+               CASE WHEN typeof(timestamp) != 'text' THEN timestamp
+                    WHEN timestamp NOT GLOB '*[^0-9]*' THEN CAST(timestamp AS INTEGER)
+                    ELSE COALESCE(CAST(strftime('%s', timestamp) AS INTEGER), 0) * 1000000000
+               END
+        FROM last_run
     ''')
-    
-    conn.commit()
-    conn.close()
\ No newline at end of file
+    _conn.execute('DROP TABLE last_run')
+    _conn.execute('ALTER TABLE last_run_new RENAME TO last_run')
+
+def init_db():
+    # This creates a file named 'state.db' in your project folder
+    # Timestamps are stored as integer nanoseconds since the epoch (time.time_ns())
+    with _conn:
+        existing = _conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'processed_emails'"
+        ).fetchone()
+        if existing and 'WITHOUT ROWID' not in existing[0].upper():
+            _migrate_processed_emails()
+        
+        existing = _conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'last_run'"
+        ).fetchone()
+        if existing and 'TIMESTAMP INTEGER' not in existing[0].upper():
+            _migrate_last_run()
+        
+        # Create a table to store processed message IDs with timestamp
+        _conn.execute(_PROCESSED_EMAILS_DDL.format(table='processed_emails'))
+        
+        # Create a table to store digests of rows already written to the sheet
+        _conn.execute('''
+            CREATE TABLE IF NOT EXISTS sheet_index (
+                digest BLOB PRIMARY KEY
+            ) WITHOUT ROWID
+        ''')
+        
+        # Create a table to store the last run timestamp
+        _conn.execute(_LAST_RUN_DDL.format(table='last_run'))
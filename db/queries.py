@@ -1,55 +1,99 @@
-import sqlite3
-from datetime import datetime
+import time
+
+from .init import _conn
+
+# Stay under SQLite's default limit of 999 bound parameters per statement
+MAX_QUERY_PARAMS = 999
 
 # check for duplicates
 def is_processed(message_id):
-    conn = sqlite3.connect('state.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT 1 FROM processed_emails WHERE message_id = ?', (message_id,))
+    cursor = _conn.execute('SELECT 1 FROM processed_emails WHERE message_id = ?', (message_id,))
     result = cursor.fetchone()
     
-    conn.close()
     return result is not None  # Returns True if ID exists
 
+# check a whole batch for duplicates; returns the IDs already processed
+def processed_subset(message_ids):
+    processed = set()
+    for start in range(0, len(message_ids), MAX_QUERY_PARAMS):
+        chunk = message_ids[start:start + MAX_QUERY_PARAMS]
+        placeholders = ','.join('?' * len(chunk))
+        cursor = _conn.execute(
+            f'SELECT message_id FROM processed_emails WHERE message_id IN ({placeholders})',
+            chunk
+        )
+        processed.update(row[0] for row in cursor)
+    
+    return processed
+
 # save the state
 def mark_as_processed(message_id):
-    conn = sqlite3.connect('state.db')
-    cursor = conn.cursor()
+    # OR IGNORE skips IDs that already exist
+    with _conn:
+        _conn.execute(
+            'INSERT OR IGNORE INTO processed_emails (message_id, processed_at) VALUES (?, ?)',
+            (message_id, time.time_ns())
+        )
+
+# insert a batch of processed IDs; callers wrap it in their transaction
+def _insert_processed(message_ids, processed_at):
+    # OR IGNORE skips IDs that already exist
+    _conn.executemany(
+        'INSERT OR IGNORE INTO processed_emails (message_id, processed_at) VALUES (?, ?)',
+        [(message_id, processed_at) for message_id in message_ids]
+    )
+
+# save the state for a whole batch in one transaction
+def mark_many_as_processed(message_ids):
+    with _conn:
+        _insert_processed(message_ids, time.time_ns())
+
+# save a completed run: processed IDs and last run timestamp in one transaction
+def record_run(message_ids):
+    timestamp = time.time_ns()
+    with _conn:
+        _insert_processed(message_ids, timestamp)
+        _conn.execute('''
+            INSERT OR REPLACE INTO last_run (id, timestamp) VALUES (1, ?)
+        ''', (timestamp,))
+    
+    return timestamp
+
+# check a batch of (sender, subject, date) digests; returns those already in the sheet
+def indexed_subset(digests):
+    indexed = set()
+    for start in range(0, len(digests), MAX_QUERY_PARAMS):
+        chunk = digests[start:start + MAX_QUERY_PARAMS]
+        placeholders = ','.join('?' * len(chunk))
+        cursor = _conn.execute(
+            f'SELECT digest FROM sheet_index WHERE digest IN ({placeholders})',
+            chunk
+        )
+        indexed.update(row[0] for row in cursor)
     
-    try:
-        cursor.execute(
-            'INSERT INTO processed_emails (message_id, processed_at) VALUES (?, ?)',
-            (message_id, datetime.utcnow().isoformat())
+    return indexed
+
+# remember digests of rows written to the sheet
+def add_sheet_digests(digests):
+    with _conn:
+        _conn.executemany(
+            'INSERT OR IGNORE INTO sheet_index (digest) VALUES (?)',
+            [(digest,) for digest in digests]
         )
-        conn.commit()
-    except sqlite3.IntegrityError:
-        # ID already exists
-        pass
-    finally:
-        conn.close()
 
 # get last run timestamp
 def get_last_run_timestamp():
-    conn = sqlite3.connect('state.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT timestamp FROM last_run WHERE id = 1')
+    cursor = _conn.execute('SELECT timestamp FROM last_run WHERE id = 1')
     result = cursor.fetchone()
     
-    conn.close()
     return result[0] if result else None
 
 # update last run timestamp
 def update_last_run_timestamp():
-    conn = sqlite3.connect('state.db')
-    cursor = conn.cursor()
-    
-    timestamp = datetime.utcnow().isoformat()
-    cursor.execute('''
-        INSERT OR REPLACE INTO last_run (id, timestamp) VALUES (1, ?)
-    ''', (timestamp,))
+    timestamp = time.time_ns()
+    with _conn:
+        _conn.execute('''
+            INSERT OR REPLACE INTO last_run (id, timestamp) VALUES (1, ?)
+        ''', (timestamp,))
     
-    conn.commit()
-    conn.close()
-    return timestamp
\ No newline at end of file
+    return timestamp
@@ -0,0 +1,58 @@
+import os
+
+from google.oauth2.credentials import Credentials
+import config
+
+
+def token_mtime():
+    """Modification time of the token file, or None if it doesn't exist yet."""
+    try:
+        return os.path.getmtime(config.TOKEN_FILE)
+    except OSError:
+        return None
+
+
+def load_credentials():
+    """
+    Load OAuth 2.0 credentials shared by the Gmail and Sheets services.
+    
+    The token is stored as JSON (Credentials.to_json). A missing or unreadable token
+    file (e.g. one pickled by an older version) triggers the browser login flow.
+    
+    Returns:
+        google.oauth2.credentials.Credentials: Valid credentials for config.SCOPES.
+    """
+    creds = None
+    
+    # Load existing token if available
+    if os.path.exists(config.TOKEN_FILE):
+        try:
+            creds = Credentials.from_authorized_user_file(config.TOKEN_FILE, config.SCOPES)
+        except ValueError:
+            creds = None
+    
+    # If no valid credentials, let user log in
+    if not creds or not creds.valid:
+        # The refresh and login dependencies (requests, oauthlib) are only imported
+        # when needed; a run with a still-valid token never loads them
+        if creds and creds.expired and creds.refresh_token:
+            from google.auth.transport.requests import Request
+            creds.refresh(Request())
+        else:
+            if not os.path.exists(config.CREDENTIALS_FILE):
+                raise FileNotFoundError(
+                    f"Credentials file not found at {config.CREDENTIALS_FILE}. "
+                    "Please download it from Google Cloud Console."
+                )
+            
+            from google_auth_oauthlib.flow import InstalledAppFlow
+            flow = InstalledAppFlow.from_client_secrets_file(
+                config.CREDENTIALS_FILE, config.SCOPES
+            )
+            creds = flow.run_local_server(port=0)
+        
+        # Save credentials for future runs (only when they changed)
+        with open(config.TOKEN_FILE, 'w') as token:
+            token.write(creds.to_json())
+    
+    return creds
@@ -1,16 +1,32 @@
-import os
-import sys
+import hashlib
+import logging
+import re
+from datetime import datetime, timezone
 
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import config
 from db.init import init_db
 from db.queries import (
     is_processed as db_is_processed, 
+    processed_subset,
     mark_as_processed as db_mark_as_processed,
+    mark_many_as_processed as db_mark_many_as_processed,
     get_last_run_timestamp,
-    update_last_run_timestamp
+    update_last_run_timestamp,
+    record_run
 )
 
+log = logging.getLogger(__name__)
+
+# Matches the address in "Name <email@example.com>"
+_ANGLE_RE = re.compile(r'<([^>]+)>')
+
+
+def _to_isoformat(timestamp):
+    """Convert a stored nanosecond timestamp to ISO format (older databases stored ISO text)."""
+    if timestamp is None or isinstance(timestamp, str):
+        return timestamp
+    return datetime.fromtimestamp(timestamp / 1e9, tz=timezone.utc).isoformat()
+
 
 class EmailStateManager:
     """Manages state to track processed emails and prevent duplicates using SQLite database."""
@@ -20,12 +36,12 @@ class EmailStateManager:
         init_db()
     
     def get_last_run_timestamp(self):
-        """Get the timestamp of the last successful run."""
-        return get_last_run_timestamp()
+        """Get the timestamp of the last successful run as an ISO format string."""
+        return _to_isoformat(get_last_run_timestamp())
     
     def update_last_run_timestamp(self):
         """Update the last run timestamp to current time."""
-        return update_last_run_timestamp()
+        return _to_isoformat(update_last_run_timestamp())
     
     def is_processed(self, email_id):
         """Check if an email has already been processed."""
@@ -35,6 +51,23 @@ class EmailStateManager:
         """Mark an email as processed in the database."""
         db_mark_as_processed(email_id)
     
+    def mark_many_as_processed(self, email_ids):
+        """Mark a batch of emails as processed in a single database transaction."""
+        db_mark_many_as_processed(email_ids)
+    
+    def record_run(self, email_ids):
+        """
+        Mark a batch of emails as processed and update the last run timestamp
+        in a single database transaction.
+        
+        Args:
+            email_ids (list): Gmail message IDs processed in this run.
+        
+        Returns:
+            str: The new last run timestamp in ISO format.
+        """
+        return _to_isoformat(record_run(email_ids))
+    
     def filter_new_emails(self, emails):
         """
         Filter out emails that have already been processed.
@@ -45,11 +78,11 @@ class EmailStateManager:
         Returns:
             list: Only emails that haven't been processed yet.
         """
-        return [email for email in emails if not self.is_processed(email['id'])]
+        processed = processed_subset([email['id'] for email in emails])
+        return [email for email in emails if email['id'] not in processed]
 
 
 def parse_email_data(email):
-    # print(email)
     """
     Parse email data into a structured format for spreadsheet insertion.
     Extracts the four critical fields: Sender's Email, Subject, Date/Time, and Plain Text Body.
@@ -58,20 +91,37 @@ def parse_email_data(email):
         email (dict): Email data from Gmail API.
     
     Returns:
-        dict: Parsed email data with sender_email, subject, date, and body.
+        dict: Parsed email data with sender_email, subject, date, body, and the
+        dedup_key used for sheet-level duplicate checks.
     """
+    log.debug('Parsing email %s', email.get('id'))
+    
     # Extract sender email from "Name <email@example.com>" format
     sender = email.get('sender', '')
     sender_email = extract_email_address(sender)
+    subject = email.get('subject', '')
+    date = email.get('date', '')
     
     return {
         'sender_email': sender_email,
-        'subject': email.get('subject', ''),
-        'date': email.get('date', ''),
-        'body': email.get('body', '')
+        'subject': subject,
+        'date': date,
+        'body': email.get('body', ''),
+        'dedup_key': dedup_key(sender_email, subject, date)
     }
 
 
+def dedup_key(sender_email, subject, date):
+    """
+    Fixed-size key identifying a (sender, subject, date) sheet row for duplicate checks.
+    
+    Returns:
+        bytes: 16-byte BLAKE2b digest.
+    """
+    key = f'{sender_email}\x1f{subject}\x1f{date}'.encode('utf-8')
+    return hashlib.blake2b(key, digest_size=16).digest()
+
+
 def extract_email_address(sender_string):
     """
     Extract email address from sender string.
@@ -82,10 +132,8 @@ def extract_email_address(sender_string):
     Returns:
         str: Just the email address.
     """
-    import re
-    
     # Match email in angle brackets: "Name <email@example.com>"
-    match = re.search(r'<([^>]+)>', sender_string)
+    match = _ANGLE_RE.search(sender_string)
     if match:
         return match.group(1)
     
@@ -1,57 +1,93 @@
-import os
-import sys
-import pickle
+import re
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import base64
 from bs4 import BeautifulSoup
 
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-import config
+from googleapiclient.http import build_http
+from .auth import load_credentials, token_mtime
+
+log = logging.getLogger(__name__)
+
+# Gmail accepts at most 100 calls in a single batch request
+BATCH_SIZE = 100
+
+# users.messages.batchModify accepts at most 1000 IDs per call
+MODIFY_BATCH_SIZE = 1000
+
+# Largest page users.messages.list will return
+LIST_PAGE_SIZE = 500
+
+# Headers read from each message; enough for the metadata-only fetch
+METADATA_HEADERS = ['Subject', 'From', 'Date']
+
+# Thread pool used to re-fetch messages that failed inside a batch
+FETCH_WORKERS = 16
+
+# Retries (with exponential backoff) for rate-limited or failed requests; only
+# used on idempotent calls (reads, and batchModify removing a label)
+API_RETRIES = 5
+
+# Batch errors worth retrying individually; anything else is reported and skipped
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# A line break (any str.splitlines() boundary) plus the whitespace around it;
+# collapses blank lines and strips each line
+_LINE_BREAK_RE = re.compile(r'\s*[\n\r\v\f\x1c-\x1e\x85\u2028\u2029]\s*')
+
+# Body MIME types in order of preference (lower wins)
+_BODY_PRIORITY = {'text/plain': 0, 'text/html': 1}
+
+
+def _walk_parts(part):
+    """Yield (mimeType, body data) for a MIME part and all of its nested parts."""
+    yield part.get('mimeType'), part.get('body', {}).get('data')
+    for sub_part in part.get('parts') or ():
+        yield from _walk_parts(sub_part)
+
+
+@functools.lru_cache(maxsize=1)
+def _build_service(mtime):
+    """
+    Authenticate using OAuth 2.0 and build the Gmail API service.
+    
+    Cached on the token file's mtime so every GmailService created in the same
+    process shares one service until the token on disk changes.
+    
+    Returns:
+        tuple: (credentials, Gmail API service).
+    """
+    creds = load_credentials()
+    
+    # Use the discovery document bundled with the client library instead of fetching it
+    service = build('gmail', 'v1', credentials=creds, static_discovery=True, cache_discovery=False)
+    return creds, service
+
 
 class GmailService:
     """Handles Gmail API authentication and email fetching operations."""
     
     def __init__(self):
+        self.creds = None
         self.service = None
+        self._emails = []
+        self._retry_ids = []
+        self._include_body = True
+        self._local = threading.local()
         self.authenticate()
     
     def authenticate(self):
         """Authenticate using OAuth 2.0 and create Gmail API service."""
-        creds = None
-        
-        # Load existing token if available
-        if os.path.exists(config.TOKEN_FILE):
-            with open(config.TOKEN_FILE, 'rb') as token:
-                creds = pickle.load(token)
-        
-        # If no valid credentials, let user log in
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                if not os.path.exists(config.CREDENTIALS_FILE):
-                    raise FileNotFoundError(
-                        f"Credentials file not found at {config.CREDENTIALS_FILE}. "
-                        "Please download it from Google Cloud Console."
-                    )
-                
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    config.CREDENTIALS_FILE, config.SCOPES
-                )
-                creds = flow.run_local_server(port=0)
-            
-            # Save credentials for future runs
-            with open(config.TOKEN_FILE, 'wb') as token:
-                pickle.dump(creds, token)
-        
-        self.service = build('gmail', 'v1', credentials=creds)
+        self.creds, self.service = _build_service(token_mtime())
     
-    def get_unread_emails(self, after_timestamp=None, subject_filter=None, exclude_noreply=True):
+    def get_unread_emails(self, after_timestamp=None, subject_filter=None, exclude_noreply=True,
+                          include_body=True, limit=None):
         """
         Fetch unread emails from the Inbox, optionally filtering by timestamp and subject.
         
@@ -59,6 +95,9 @@ class GmailService:
             after_timestamp (str, optional): ISO format timestamp to fetch emails after.
             subject_filter (str, optional): Subject keyword to filter emails (Gmail search syntax).
             exclude_noreply (bool, optional): Exclude automated no-reply emails. Default True.
+            include_body (bool, optional): Fetch and decode the full body. When False, only the
+                Subject/From/Date headers are requested and the snippet is used as body. Default True.
+            limit (int, optional): Maximum number of emails to fetch. Default None (all matches).
         
         Returns:
             list: List of email dictionaries with id, subject, sender, date, and body.
@@ -86,115 +125,212 @@ class GmailService:
             if exclude_noreply:
                 query += ' -from:noreply -from:no-reply -from:donotreply -from:do-not-reply'
             
-            results = self.service.users().messages().list(
-                userId='me',
-                q=query,
-                maxResults=100
-            ).execute()
-            
-            messages = results.get('messages', [])
+            # Page through the results until the limit is reached or there are no more pages
+            messages = []
+            page_token = None
+            while limit is None or len(messages) < limit:
+                page_size = LIST_PAGE_SIZE if limit is None else min(LIST_PAGE_SIZE, limit - len(messages))
+                results = self.service.users().messages().list(
+                    userId='me',
+                    q=query,
+                    maxResults=page_size,
+                    pageToken=page_token,
+                    fields='messages/id,nextPageToken'
+                ).execute(num_retries=API_RETRIES)
+                
+                messages.extend(results.get('messages', []))
+                page_token = results.get('nextPageToken')
+                if not page_token:
+                    break
             
             if not messages:
                 return []
             
-            emails = []
-            for message in messages:
-                email_data = self._get_email_details(message['id'])
-                if email_data:
-                    emails.append(email_data)
+            # Fetch message details in batches instead of one request per message
+            self._emails = []
+            self._retry_ids = []
+            self._include_body = include_body
+            for start in range(0, len(messages), BATCH_SIZE):
+                chunk = messages[start:start + BATCH_SIZE]
+                batch = self.service.new_batch_http_request(callback=self._on_message)
+                for message in chunk:
+                    batch.add(
+                        self._message_request(message['id'], include_body),
+                        request_id=message['id']
+                    )
+                
+                try:
+                    batch.execute()
+                except HttpError as error:
+                    print(f"Batch request failed, fetching messages individually: {error}")
+                    self._retry_ids.extend(message['id'] for message in chunk)
+            
+            emails, self._emails = self._emails, []
+            
+            # Fall back to concurrent single fetches for anything the batch couldn't get
+            if self._retry_ids:
+                emails.extend(self._fetch_concurrently(self._retry_ids, include_body))
+                self._retry_ids = []
             
+            log.debug('Fetched %d emails', len(emails))
             return emails
         
         except HttpError as error:
             print(f"An error occurred: {error}")
             return []
     
-    def _get_email_details(self, message_id):
+    def _on_message(self, request_id, response, exception):
+        """Batch callback: parse a fetched message or report the failure."""
+        if exception is not None:
+            if isinstance(exception, HttpError) and exception.resp.status in RETRYABLE_STATUSES:
+                self._retry_ids.append(request_id)
+            else:
+                print(f"Error fetching email {request_id}: {exception}")
+            return
+        
+        self._emails.append(self._parse_message(response, self._include_body))
+    
+    def _fetch_concurrently(self, message_ids, include_body=True):
         """
-        Fetch detailed information for a specific email.
+        Fetch messages one request each, spread across a bounded thread pool.
         
         Args:
-            message_id (str): The Gmail message ID.
+            message_ids (list): Gmail message IDs to fetch.
+            include_body (bool, optional): Fetch the full body instead of the snippet. Default True.
         
         Returns:
-            dict: Email details including id, subject, sender, date, and snippet.
+            list: Email dictionaries for the messages that could be fetched.
         """
-        try:
-            message = self.service.users().messages().get(
+        def fetch(message_id):
+            return self._get_email_details(message_id, include_body, http=self._thread_http())
+        
+        with ThreadPoolExecutor(max_workers=min(FETCH_WORKERS, len(message_ids))) as executor:
+            return [email for email in executor.map(fetch, message_ids) if email]
+    
+    def _thread_http(self):
+        """
+        Per-thread authorized HTTP client; httplib2.Http is not thread-safe.
+        
+        Built with build_http() like the service's own client, so requests get the
+        same default socket timeout instead of waiting forever on a stalled connection.
+        """
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = AuthorizedHttp(self.creds, http=build_http())
+            self._local.http = http
+        return http
+    
+    def _message_request(self, message_id, include_body=True):
+        """
+        Build the users.messages.get request for a message.
+        
+        The metadata format skips the MIME tree and base64 body entirely, so it is
+        used whenever the body is not needed.
+        """
+        if include_body:
+            return self.service.users().messages().get(
                 userId='me',
                 id=message_id,
                 format='full'
-            ).execute()
+            )
+        
+        return self.service.users().messages().get(
+            userId='me',
+            id=message_id,
+            format='metadata',
+            metadataHeaders=METADATA_HEADERS
+        )
+    
+    def _get_email_details(self, message_id, include_body=True, http=None):
+        """
+        Fetch detailed information for a specific email.
+        
+        Args:
+            message_id (str): The Gmail message ID.
+            include_body (bool, optional): Fetch the full body instead of the snippet. Default True.
+            http (httplib2.Http, optional): HTTP client to send the request with. Defaults to
+                the service's own client.
+        
+        Returns:
+            dict: Email details including id, subject, sender, date, and body.
+        """
+        try:
+            message = self._message_request(message_id, include_body).execute(
+                http=http,
+                num_retries=API_RETRIES
+            )
 
-            # print(message)
-            
-            headers = message['payload']['headers']
+            log.debug('Fetched message %s', message_id)
             
-            # Extract relevant headers
-            subject = self._get_header_value(headers, 'Subject')
-            sender = self._get_header_value(headers, 'From')
-            date = self._get_header_value(headers, 'Date')
-            body = self.get_full_body(message['payload'])
-            
-            return {
-                'id': message_id,
-                'subject': subject,
-                'sender': sender,
-                'date': date,
-                'body': body,
-            }
+            return self._parse_message(message, include_body)
         
         except HttpError as error:
             print(f"Error fetching email {message_id}: {error}")
             return None
     
-    def _get_header_value(self, headers, name):
-        """Extract header value by name from email headers."""
-        for header in headers:
-            if header['name'] == name:
-                return header['value']
-        return ''
-
+    def _parse_message(self, message, include_body=True):
+        """
+        Extract the relevant fields from an already-fetched Gmail message.
+        
+        Args:
+            message (dict): Message resource returned by users.messages.get.
+            include_body (bool, optional): Whether the message was fetched in full format.
+                If False, the snippet is used as body. Default True.
+        
+        Returns:
+            dict: Email details including id, subject, sender, date, and body.
+        """
+        # Index headers by name once instead of scanning the list per lookup
+        headers = {header['name']: header['value'] for header in message['payload']['headers']}
+        
+        # Extract relevant headers
+        subject = headers.get('Subject', '')
+        sender = headers.get('From', '')
+        date = headers.get('Date', '')
+        if include_body:
+            body = self.get_full_body(message['payload'])
+        else:
+            body = message.get('snippet', '')
+        
+        return {
+            'id': message['id'],
+            'subject': subject,
+            'sender': sender,
+            'date': date,
+            'body': body,
+        }
+    
     def get_full_body(self, message_payload):
         """
         Recursively extracts and cleans the email body.
+        
+        Walks the whole MIME tree once (including nested multiparts such as
+        multipart/alternative inside multipart/mixed) and prefers text/plain over text/html.
         """
-        body_data = None
-        is_html = False
-
-        # 1. Check top-level payload
-        if 'body' in message_payload and message_payload['body'].get('data'):
-            body_data = message_payload['body']['data']
-            is_html = message_payload.get('mimeType') == 'text/html'
-        
-        # 2. Look through multipart parts
-        if not body_data and 'parts' in message_payload:
-            for part in message_payload['parts']:
-                # Prioritize plain text if available
-                if part['mimeType'] == 'text/plain':
-                    body_data = part.get('body', {}).get('data')
-                    is_html = False
-                    break
-                # Fallback to HTML if no plain text is found yet
-                elif part['mimeType'] == 'text/html':
-                    body_data = part.get('body', {}).get('data')
-                    is_html = True
+        candidates = [
+            (mime_type, data) for mime_type, data in _walk_parts(message_payload)
+            if data and mime_type in _BODY_PRIORITY
+        ]
 
-        if body_data:
+        if candidates:
+            mime_type, body_data = min(candidates, key=lambda candidate: _BODY_PRIORITY[candidate[0]])
+            is_html = mime_type == 'text/html'
+            
             # Decode the Base64url data
-            decoded_text = base64.urlsafe_b64decode(body_data).decode('utf-8')
+            raw = base64.urlsafe_b64decode(body_data)
             
             if is_html:
-                soup = BeautifulSoup(decoded_text, 'html.parser')
+                # lxml's C parser is much faster than the pure-Python html.parser.
+                # Hand it the raw bytes so the document is only converted to text once,
+                # using the charset declared in the HTML itself.
+                soup = BeautifulSoup(raw, 'lxml')
                 # Remove scripts and styles
                 for script_or_style in soup(["script", "style"]):
                     script_or_style.decompose()
                 text = soup.get_text(separator=' ').strip()
-                lines = text.splitlines()
-                clean_lines = [line.strip() for line in lines if line.strip()]
-                return "\n".join(clean_lines)
+                return _LINE_BREAK_RE.sub('\n', text)
             
-            return decoded_text.strip()
+            return raw.decode('utf-8').strip()
         
         return "No content found"
     
@@ -212,14 +348,15 @@ class GmailService:
             return True
         
         try:
-            # Use batchModify to remove UNREAD label from multiple messages
-            self.service.users().messages().batchModify(
-                userId='me',
-                body={
-                    'ids': message_ids,
-                    'removeLabelIds': ['UNREAD']
-                }
-            ).execute()
+            # Use batchModify to remove UNREAD label from up to 1000 messages per call
+            for start in range(0, len(message_ids), MODIFY_BATCH_SIZE):
+                self.service.users().messages().batchModify(
+                    userId='me',
+                    body={
+                        'ids': message_ids[start:start + MODIFY_BATCH_SIZE],
+                        'removeLabelIds': ['UNREAD']
+                    }
+                ).execute(num_retries=API_RETRIES)
             
             print(f"✓ Marked {len(message_ids)} emails as read in Gmail")
             return True
@@ -1,15 +1,30 @@
-import sys
-import os
+import argparse
 
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from gmail_service import GmailService
-from sheets_service import SheetsService
-from email_parser import EmailStateManager, parse_email_data
 import config
+from .gmail_service import GmailService
+from .sheets_service import SheetsService
+from .email_parser import EmailStateManager, parse_email_data
+
+
+def parse_args():
+    """Parse command line options."""
+    parser = argparse.ArgumentParser(description="Log new Gmail messages to Google Sheets.")
+    parser.add_argument(
+        '--rebuild-index',
+        action='store_true',
+        help="Re-read the spreadsheet to rebuild the local duplicate index."
+    )
+    parser.add_argument(
+        '--force-init',
+        action='store_true',
+        help="Re-check the sheet's header row even if it was set up on an earlier run."
+    )
+    return parser.parse_args()
 
 
 def main():
     """Main execution flow for Gmail-to-Sheets automation."""
+    args = parse_args()
     
     print("Starting Gmail-to-Sheets Automation...")
     print("=" * 60)
@@ -27,24 +42,8 @@ def main():
     gmail = GmailService()
     print("✓ Gmail authentication successful")
     
-    # Initialize Sheets service
-    print("\n2. Authenticating with Google Sheets API...")
-    sheets = SheetsService()
-    
-    # Verify spreadsheet access
-    if not sheets.verify_spreadsheet_access():
-        print("\n⚠ ERROR: Cannot access spreadsheet. Please check:")
-        print("  - SPREADSHEET_ID is correct in config.py")
-        print("  - You have edit access to the spreadsheet")
-        print("  - Google Sheets API is enabled in Google Cloud Console")
-        return
-    
-    # Initialize sheet with headers
-    print("\n3. Initializing spreadsheet...")
-    sheets.initialize_sheet()
-    
     # Initialize state manager
-    print("\n4. Loading state manager...")
+    print("\n2. Loading state manager...")
     state_manager = EmailStateManager()
     last_run = state_manager.get_last_run_timestamp()
     if last_run:
@@ -53,7 +52,7 @@ def main():
         print("✓ State manager initialized (first run)")
     
     # Fetch unread emails since last run
-    print("\n5. Fetching new emails from Inbox...")
+    print("\n3. Fetching new emails from Inbox...")
     subject_filter = None
     exclude_noreply = True
     
@@ -75,10 +74,37 @@ def main():
         print(f"✓ Found {len(unread_emails)} emails since last run")
     
     # Filter out already processed emails
-    print("\n6. Filtering new emails...")
+    print("\n4. Filtering new emails...")
     new_emails = state_manager.filter_new_emails(unread_emails)
     print(f"✓ {len(new_emails)} new emails to process")
     
+    # Sheets is only touched when there is something to write (or a maintenance flag was given)
+    sheets_maintenance = args.rebuild_index or args.force_init
+    if not new_emails and not sheets_maintenance:
+        print("\n✓ No new emails to process. Exiting.")
+        return
+    
+    # Initialize Sheets service
+    print("\n5. Authenticating with Google Sheets API...")
+    sheets = SheetsService()
+    
+    # Forget the header sentinel before bootstrap(), so its cached shortcut
+    # can't vouch for the header and the header row is actually read
+    if args.force_init:
+        sheets.reset_initialization()
+    
+    # Verify spreadsheet access and read the header row in one request
+    if not sheets.bootstrap(rebuild_index=args.rebuild_index):
+        print("\n⚠ ERROR: Cannot access spreadsheet. Please check:")
+        print("  - SPREADSHEET_ID is correct in config.py")
+        print("  - You have edit access to the spreadsheet")
+        print("  - Google Sheets API is enabled in Google Cloud Console")
+        return
+    
+    # Initialize sheet with headers
+    print("\n6. Initializing spreadsheet...")
+    sheets.initialize_sheet(defer_header=bool(new_emails))
+    
     if not new_emails:
         print("\n✓ No new emails to process. Exiting.")
         return
@@ -98,17 +124,24 @@ def main():
             print(f"    Date: {email['date']}")
             print(f"    Body: {email['body'][:80]}..." if len(email['body']) > 80 else f"    Body: {email['body']}")
     
+    new_email_ids = [email['id'] for email in new_emails]
+    
     # Add to Google Sheets
     print("\n8. Adding emails to Google Sheets...")
     rows_added = sheets.append_emails(parsed_emails)
+    
+    # Leave the emails unprocessed and unread so the next run picks them up again
+    if rows_added is None:
+        print("\n⚠ ERROR: Could not add emails to the spreadsheet. They will be retried on the next run.")
+        return
     print(f"✓ Added {rows_added} rows to spreadsheet")
     
-    # Mark emails as processed and update last run timestamp
+    # Mark emails as processed and update last run timestamp. Emails are only
+    # marked as read once the append has succeeded; if it fails or raises, they
+    # stay unread and are picked up again on the next run.
     print("\n9. Updating state...")
-    for email in new_emails:
-        state_manager.mark_as_processed(email['id'])
-    state_manager.update_last_run_timestamp()
-    gmail.mark_emails_as_read([email['id'] for email in new_emails])
+    state_manager.record_run(new_email_ids)
+    gmail.mark_emails_as_read(new_email_ids)
     print("✓ State updated")
     
     print("\n" + "=" * 60)
@@ -1,14 +1,42 @@
+import functools
 import os
-import sys
-import pickle
+import random
+import time
+from operator import itemgetter
 
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 import config
+from db.init import init_db
+from db.queries import indexed_subset, add_sheet_digests
+from .auth import load_credentials, token_mtime
+from .email_parser import dedup_key
+
+# Header row written at the top of an empty sheet
+HEADERS = ['Sender Email', 'Subject', 'Date', 'Body']
+
+# Retries (with jittered exponential backoff) for rate-limited or failed API calls
+API_RETRIES = 5
+
+# 403 reasons that mean the request was rejected for rate limiting, not permissions
+_RATE_LIMIT_REASONS = (b'rateLimitExceeded', b'userRateLimitExceeded')
+
+# Pulls a parsed email's fields in HEADERS order
+_row_values = itemgetter('sender_email', 'subject', 'date', 'body')
+
+
+@functools.lru_cache(maxsize=1)
+def _build_service(mtime):
+    """
+    Authenticate using OAuth 2.0 and build the Sheets API service.
+    
+    Cached on the token file's mtime so every SheetsService created in the same
+    process shares one service until the token on disk changes.
+    """
+    creds = load_credentials()
+    
+    # Use the discovery document bundled with the client library instead of fetching it
+    return build('sheets', 'v4', credentials=creds, static_discovery=True, cache_discovery=False)
 
 
 class SheetsService:
@@ -18,92 +46,234 @@ class SheetsService:
         self.service = None
         self.spreadsheet_id = config.SPREADSHEET_ID
         self.sheet_name = config.SHEET_NAME
+        
+        # Filled in by bootstrap()
+        self._header_present = None
+        
+        # Set by initialize_sheet() when the header should go out with the first append
+        self._pending_header = False
+        
+        # Local index of rows already in the sheet, so duplicate checks don't
+        # have to download the whole sheet on every run
+        init_db()
+        
         self.authenticate()
     
     def authenticate(self):
         """Authenticate using OAuth 2.0 and create Sheets API service."""
-        creds = None
+        self.service = _build_service(token_mtime())
+    
+    def _execute(self, request):
+        """
+        Execute an API request, retrying 429 and 5xx responses with jittered
+        exponential backoff before giving up with HttpError.
         
-        # Load existing token if available
-        if os.path.exists(config.TOKEN_FILE):
-            with open(config.TOKEN_FILE, 'rb') as token:
-                creds = pickle.load(token)
+        A retry can repeat a request the server already applied, so writes that
+        aren't idempotent (values.append) go through _execute_write instead.
+        """
+        return request.execute(num_retries=API_RETRIES)
+    
+    def _execute_write(self, request):
+        """
+        Execute a request that isn't idempotent, retrying only rate-limit rejections.
         
-        # If no valid credentials, let user log in
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                if not os.path.exists(config.CREDENTIALS_FILE):
-                    raise FileNotFoundError(
-                        f"Credentials file not found at {config.CREDENTIALS_FILE}. "
-                        "Please download it from Google Cloud Console."
-                    )
-                
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    config.CREDENTIALS_FILE, config.SCOPES
+        429 and rate-limit 403 responses mean the server refused the write, so it is
+        safe to send again. A 5xx or a network error may come after the write was
+        applied, so those are raised without a retry.
+        """
+        for attempt in range(API_RETRIES + 1):
+            try:
+                return request.execute()
+            except HttpError as error:
+                status = error.resp.status
+                rate_limited = status == 429 or (
+                    status == 403 and any(reason in error.content for reason in _RATE_LIMIT_REASONS)
                 )
-                creds = flow.run_local_server(port=0)
+                if not rate_limited or attempt == API_RETRIES:
+                    raise
+                
+                # Same jittered exponential backoff as num_retries
+                time.sleep(random.random() * 2 ** (attempt + 1))
+    
+    def bootstrap(self, rebuild_index=False):
+        """
+        Verify access and read the header row with a single spreadsheets.get request.
+        
+        Replaces the separate round-trips of verify_spreadsheet_access, the header check in
+        initialize_sheet and, when rebuilding the index, get_existing_emails.
+        
+        Args:
+            rebuild_index (bool, optional): Also read every row and add it to the local
+                duplicate index. Default False.
+        
+        Returns:
+            bool: True if the spreadsheet is accessible, False otherwise.
+        """
+        # Access and header were both confirmed recently, nothing left to read
+        if not rebuild_index and self._access_recently_verified() and self._header_initialized():
+            self._header_present = True
+            print("✓ Spreadsheet access verified recently (cached)")
+            return True
+        
+        # The header row, or when rebuilding, every row's hashed columns (A-C)
+        cells = 'A1:C' if rebuild_index else 'A1:D1'
+        try:
+            spreadsheet = self._execute(self.service.spreadsheets().get(
+                spreadsheetId=self.spreadsheet_id,
+                ranges=[f'{self.sheet_name}!{cells}'],
+                includeGridData=True,
+                fields='properties.title,'
+                       'sheets(properties.title,data.rowData.values.formattedValue)'
+            ))
+        
+        except HttpError as error:
+            self._clear_access_verified()
+            print(f"✗ Error accessing spreadsheet: {error}")
+            print(f"  Make sure SPREADSHEET_ID in config.py is correct")
+            return False
+        
+        title = spreadsheet.get('properties', {}).get('title', 'Unknown')
+        print(f"✓ Connected to spreadsheet: '{title}'")
+        self._mark_access_verified()
+        
+        rows = []
+        for sheet in spreadsheet.get('sheets', []):
+            if sheet.get('properties', {}).get('title') != self.sheet_name:
+                continue
             
-            # Save credentials for future runs
-            with open(config.TOKEN_FILE, 'wb') as token:
-                pickle.dump(creds, token)
+            for data in sheet.get('data', []):
+                for row in data.get('rowData', []):
+                    rows.append([cell.get('formattedValue', '') for cell in row.get('values', [])])
+        
+        self._header_present = bool(rows and any(rows[0]))
+        
+        if rebuild_index:
+            # Skip header row
+            digests = {dedup_key(*row[:3]) for row in rows[1:] if len(row) >= 3}
+            self._add_to_index(digests)
+            print(f"✓ Duplicate index rebuilt ({len(digests)} rows)")
         
-        self.service = build('sheets', 'v4', credentials=creds)
+        return True
     
-    def initialize_sheet(self):
+    def initialize_sheet(self, defer_header=True):
         """
         Initialize the sheet with headers if it's empty or create headers.
         
+        By default a missing header row is not written here; it is prepended to the
+        first append_emails() request so both go out in a single call.
+        
+        Args:
+            defer_header (bool, optional): Leave a missing header for append_emails().
+                Pass False when nothing will be appended, to write it right away.
+                Default True.
+        
         Returns:
             bool: True if initialization successful, False otherwise.
         """
+        # Headers were already set up for this sheet on an earlier run
+        if self._header_initialized():
+            return True
+        
         try:
-            # Check if sheet has headers
-            result = self.service.spreadsheets().values().get(
-                spreadsheetId=self.spreadsheet_id,
-                range=f'{self.sheet_name}!A1:D1'
-            ).execute()
+            # Check if sheet has headers, unless bootstrap() already did
+            if self._header_present is None:
+                result = self._execute(self.service.spreadsheets().values().get(
+                    spreadsheetId=self.spreadsheet_id,
+                    range=f'{self.sheet_name}!A1:D1',
+                    fields='values'
+                ))
+                
+                self._header_present = bool(result.get('values', []))
             
-            values = result.get('values', [])
+            # If no headers, add them together with the first rows
+            if not self._header_present and defer_header:
+                self._pending_header = True
+                return True
             
-            # If no headers, add them
-            if not values:
-                headers = [['Sender Email', 'Subject', 'Date', 'Body']]
-                self.service.spreadsheets().values().update(
+            # If no headers and nothing to append, add them now
+            if not self._header_present:
+                self._execute(self.service.spreadsheets().values().update(
                     spreadsheetId=self.spreadsheet_id,
                     range=f'{self.sheet_name}!A1:D1',
                     valueInputOption='RAW',
-                    body={'values': headers}
-                ).execute()
+                    body={'values': [HEADERS]},
+                    fields='updatedRows'
+                ))
+                self._header_present = True
                 print("✓ Headers added to sheet")
             
+            self._mark_header_initialized()
+            
             return True
         
         except HttpError as error:
             print(f"Error initializing sheet: {error}")
             return False
     
+    def reset_initialization(self):
+        """Forget that the header row was set up, so the next initialize_sheet re-checks it."""
+        if os.path.exists(config.HEADER_SENTINEL):
+            os.remove(config.HEADER_SENTINEL)
+    
+    def _sentinel_key(self):
+        """Identifies the sheet the header sentinel was written for."""
+        return f'{self.spreadsheet_id}!{self.sheet_name}'
+    
+    def _header_initialized(self):
+        """Whether the header sentinel exists and was written for this sheet."""
+        try:
+            with open(config.HEADER_SENTINEL) as sentinel:
+                return sentinel.read() == self._sentinel_key()
+        except OSError:
+            return False
+    
+    def _mark_header_initialized(self):
+        """Write the header sentinel for this sheet."""
+        with open(config.HEADER_SENTINEL, 'w') as sentinel:
+            sentinel.write(self._sentinel_key())
+    
+    def _access_recently_verified(self):
+        """Whether access to this sheet was confirmed within the last ACCESS_CACHE_TTL seconds."""
+        try:
+            if time.time() - os.path.getmtime(config.ACCESS_CACHE_FILE) >= config.ACCESS_CACHE_TTL:
+                return False
+            with open(config.ACCESS_CACHE_FILE) as cache:
+                return cache.read() == self._sentinel_key()
+        except OSError:
+            return False
+    
+    def _mark_access_verified(self):
+        """Record a successful access check for this sheet."""
+        with open(config.ACCESS_CACHE_FILE, 'w') as cache:
+            cache.write(self._sentinel_key())
+    
+    def _clear_access_verified(self):
+        """Drop the access cache so the next run checks the spreadsheet again."""
+        if os.path.exists(config.ACCESS_CACHE_FILE):
+            os.remove(config.ACCESS_CACHE_FILE)
+    
     def get_existing_emails(self):
         """
         Retrieve all existing email data from the sheet to check for duplicates.
         
         Returns:
-            set: Set of tuples (sender_email, subject, date) for duplicate checking.
+            set: Set of 16-byte digests of (sender_email, subject, date) for duplicate checking.
         """
         try:
-            result = self.service.spreadsheets().values().get(
+            result = self._execute(self.service.spreadsheets().values().get(
                 spreadsheetId=self.spreadsheet_id,
-                range=f'{self.sheet_name}!A2:C'  # Skip header row
-            ).execute()
+                range=f'{self.sheet_name}!A2:C',  # Skip header row
+                fields='values'
+            ))
             
             values = result.get('values', [])
             
-            # Create set of unique identifiers (sender, subject, date)
+            # Create set of unique identifiers (sender, subject, date); a fixed-size
+            # digest per row is far smaller than a tuple of three strings
             existing = set()
             for row in values:
                 if len(row) >= 3:
-                    existing.add((row[0], row[1], row[2]))
+                    existing.add(dedup_key(row[0], row[1], row[2]))
             
             return existing
         
@@ -111,63 +281,76 @@ class SheetsService:
             print(f"Error reading existing emails: {error}")
             return set()
     
-    def append_emails(self, parsed_emails):
+    def _add_to_index(self, digests):
+        """Add row digests to the local duplicate index."""
+        add_sheet_digests(digests)
+    
+    def append_emails(self, parsed_emails, skip_dedup_check=False):
         """
         Append parsed email data to the sheet, avoiding duplicates.
         
+        Rows whose (sender, subject, date) are already in the local index are skipped.
+        This method never reads the sheet; the index is a local SQLite lookup of just
+        the digests in this batch.
+        
         Args:
             parsed_emails (list): List of parsed email dictionaries.
+            skip_dedup_check (bool, optional): Write every email without checking the
+                local index. Default False.
         
         Returns:
-            int: Number of emails successfully added.
+            int: Number of emails successfully added, or None if the append failed.
         """
         if not parsed_emails:
             return 0
         
         try:
-            # Get existing emails to prevent duplicates
-            existing_emails = self.get_existing_emails()
-            
-            # Prepare rows to append
-            rows_to_add = []
-            for email in parsed_emails:
-                email_key = (
-                    email['sender_email'],
-                    email['subject'],
-                    email['date']
-                )
-                
-                # Only add if not already in sheet
-                if email_key not in existing_emails:
-                    rows_to_add.append([
-                        email['sender_email'],
-                        email['subject'],
-                        email['date'],
-                        email['body']
-                    ])
+            # Prepare rows to append, only for emails not already in sheet
+            if skip_dedup_check:
+                new_emails = parsed_emails
+            else:
+                seen = indexed_subset([email['dedup_key'] for email in parsed_emails])
+                new_emails = [email for email in parsed_emails if email['dedup_key'] not in seen]
+            rows_to_add = [list(_row_values(email)) for email in new_emails]
             
             if not rows_to_add:
                 print("⚠ All emails already exist in sheet (duplicates prevented)")
-                return 0
+                if not self._pending_header:
+                    return 0
             
-            # Append rows to sheet
-            body = {'values': rows_to_add}
-            result = self.service.spreadsheets().values().append(
+            # Append rows to sheet, preceded by the header row on first run
+            if self._pending_header:
+                body = {'values': [HEADERS] + rows_to_add}
+            else:
+                body = {'values': rows_to_add}
+            result = self._execute_write(self.service.spreadsheets().values().append(
                 spreadsheetId=self.spreadsheet_id,
                 range=f'{self.sheet_name}!A:D',
                 valueInputOption='RAW',
                 insertDataOption='INSERT_ROWS',
-                body=body
-            ).execute()
+                body=body,
+                fields='updates.updatedRows'
+            ))
             
             updates = result.get('updates', {})
             rows_added = updates.get('updatedRows', 0)
             
+            if self._pending_header:
+                rows_added -= 1
+                self._pending_header = False
+                self._header_present = True
+                self._mark_header_initialized()
+                print("✓ Headers added to sheet")
+            
+            # Record the new rows in the local index
+            self._add_to_index({email['dedup_key'] for email in new_emails})
+            
             return rows_added
         
         except HttpError as error:
+            self._clear_access_verified()
             print(f"Error appending to sheet: {error}")
-            return 0
+            return None
     
     def verify_spreadsheet_access(self):
         """
@@ -176,16 +359,23 @@ class SheetsService:
         Returns:
             bool: True if accessible, False otherwise.
         """
+        # Checked successfully within the last ACCESS_CACHE_TTL seconds
+        if self._access_recently_verified():
+            return True
+        
         try:
-            spreadsheet = self.service.spreadsheets().get(
-                spreadsheetId=self.spreadsheet_id
-            ).execute()
+            spreadsheet = self._execute(self.service.spreadsheets().get(
+                spreadsheetId=self.spreadsheet_id,
+                fields='properties.title'
+            ))
             
             title = spreadsheet.get('properties', {}).get('title', 'Unknown')
             print(f"✓ Connected to spreadsheet: '{title}'")
+            self._mark_access_verified()
             return True
         
         except HttpError as error:
+            self._clear_access_verified()
             print(f"✗ Error accessing spreadsheet: {error}")
             print(f"  Make sure SPREADSHEET_ID in config.py is correct")
             return False